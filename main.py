@@ -5,15 +5,27 @@ import traceback
 import re
 import io
 import zipfile
-from typing import TypedDict, Any, Dict, Type, List
+import tempfile
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict, Any, Dict, Type, List, Optional, Tuple, Union, IO
 from pathlib import Path
+from types import CodeType
 from datetime import datetime
 
 import functions_framework
 from google.cloud import storage, firestore
+from google.cloud.exceptions import GoogleCloudError, NotFound
 from google.cloud.firestore_v1.base_query import FieldFilter
 from firebase_admin import credentials, initialize_app, auth
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import orjson
 from typing import TypedDict, Any, Dict, Type, List, Annotated
 
 from RestrictedPython import compile_restricted
@@ -29,23 +41,55 @@ PROJECT_ID = os.environ.get("PROJECT_ID")
 PROJECT_REGION = os.environ.get("PROJECT_REGION")
 GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME")
 FILE_BUCKET_NAME = os.environ.get("FILE_BUCKET_NAME")
+# ZIP内の1ファイルあたりの最大展開サイズ（バイト）。これを超えるファイルは解析対象外とする
+ZIP_MAX_ENTRY_BYTES = int(os.environ.get("ZIP_MAX_ENTRY_BYTES", 10 * 1024 * 1024))
+# GCSからファイルを並列に読み込む際の最大スレッド数
+FILE_LOAD_MAX_WORKERS = 16
+# ワークフロー一覧APIの1ページあたりの件数（デフォルト / 上限）
+WORKFLOW_LIST_DEFAULT_LIMIT = 50
+WORKFLOW_LIST_MAX_LIMIT = 100
+# 検証済みIDトークンをキャッシュする最大件数
+TOKEN_CACHE_MAX_SIZE = 10000
+# GCSのバッチリクエスト1回にまとめる削除の最大件数（GCSの上限は100件）
+GCS_BATCH_MAX_SIZE = 100
 
 # --- Firebase Admin SDKの初期化 ---
 if os.path.exists("./credential.json"):
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.abspath("./credential.json")
-    cred = credentials.Certificate(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
-    initialize_app(cred)
-else:
-    initialize_app()
+# 認証に必要なため起動時に初期化する（テストなどでは SKIP_FIREBASE_INIT=1 で省略できる）
+if os.environ.get("SKIP_FIREBASE_INIT") != "1":
+    if os.path.exists("./credential.json"):
+        cred = credentials.Certificate(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+        initialize_app(cred)
+    else:
+        initialize_app()
 
 
 # --- モデルとクライアントの初期化 ---
-llm = VertexAI(model_name=GEMINI_MODEL_NAME)
-db = firestore.Client()
-storage_client = storage.Client()
+# コールドスタートを短くするため、各クライアントは最初に必要になった時点で生成する
+@functools.cache
+def get_llm() -> VertexAI:
+    return VertexAI(model_name=GEMINI_MODEL_NAME)
+
+@functools.cache
+def get_db() -> firestore.Client:
+    return firestore.Client()
+
+@functools.cache
+def get_storage() -> storage.Client:
+    return storage.Client()
+
+@functools.cache
+def get_bucket() -> storage.Bucket:
+    return get_storage().bucket(FILE_BUCKET_NAME)
 
 
 # --- 認証ヘルパー関数 ---
+# 検証済みIDトークンのキャッシュ（トークンのハッシュ -> (uid, 有効期限のUNIX時刻)）
+# 同じクライアントからの連続したリクエストで、署名検証を毎回行わないようにする
+_TOKEN_CACHE: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_TOKEN_CACHE_LOCK = threading.Lock()
+
 def _get_uid_from_request(request):
     """リクエストヘッダーからIDトークンを検証し、UIDを返す"""
     auth_header = request.headers.get("Authorization")
@@ -53,17 +97,81 @@ def _get_uid_from_request(request):
         raise PermissionError("Authorization header is missing or invalid.")
     
     id_token = auth_header.split("Bearer ")[1]
+    token_hash = hashlib.blake2b(id_token.encode('utf-8'), digest_size=16).hexdigest()
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(token_hash)
+        if cached is not None:
+            if cached[1] > time.time():
+                _TOKEN_CACHE.move_to_end(token_hash)
+                return cached[0]
+            del _TOKEN_CACHE[token_hash]
+
     try:
         decoded_token = auth.verify_id_token(id_token)
-        return decoded_token['uid']
     except Exception as e:
         raise PermissionError(f"Invalid ID token: {e}")
 
+    uid = decoded_token['uid']
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[token_hash] = (uid, decoded_token['exp'])
+        _TOKEN_CACHE.move_to_end(token_hash)
+        if len(_TOKEN_CACHE) > TOKEN_CACHE_MAX_SIZE:
+            _TOKEN_CACHE.popitem(last=False)
+    return uid
+
+# --- Firestoreヘルパー関数 ---
+def _get_owned_workflow(doc_ref, uid: str, transaction=None) -> Optional[dict]:
+    """
+    ワークフローを1回の読み取りで取得し、存在してuidが所有者であればその内容を返す。
+    存在しない、または所有者でない場合はNoneを返す。
+    """
+    doc = doc_ref.get(transaction=transaction)
+    if not doc.exists:
+        return None
+    doc_data = doc.to_dict()
+    if doc_data.get('userId') != uid:
+        return None
+    return doc_data
+
 # --- Zipファイル解析ヘルパー関数 ---
-def _parse_zip_file(zip_content_bytes: bytes, additional_excluded_extensions: List[str] = None) -> dict:
+# バイナリ判定で先頭から調べるバイト数
+BINARY_SNIFF_BYTES = 512
+# テキストにはほとんど現れない制御文字（タブ・改行・垂直タブ・改ページ・復帰を除く）
+_CONTROL_BYTES = bytes(range(0, 9)) + bytes(range(14, 32))
+
+def _looks_binary(head: bytes) -> bool:
+    """ファイル先頭のバイト列から、バイナリファイルかどうかを簡易的に判定する"""
+    if not head:
+        return False
+    if b'\x00' in head:
+        return True
+    control_count = len(head) - len(head.translate(None, _CONTROL_BYTES))
+    return control_count > len(head) // 4
+
+def _build_exclusion_pattern(excluded_dirs, excluded_files, excluded_extensions) -> Optional[re.Pattern]:
+    """
+    ディレクトリ・ファイル名・拡張子の除外ルールを、大文字小文字を区別しない1つの正規表現にまとめる。
+    除外ルールが1つもない場合はNoneを返す。
     """
-    メモリ上のZIPファイルコンテンツを解析し、指定されたルールでフィルタリングする。
+    alternatives = []
+    if excluded_dirs:
+        # パスの先頭が除外ディレクトリ
+        alternatives.append(r"^(?:" + "|".join(map(re.escape, excluded_dirs)) + r")")
+    if excluded_files:
+        # パスの最後の要素（ファイル名）が除外ファイル
+        alternatives.append(r"(?:^|/)(?:" + "|".join(map(re.escape, excluded_files)) + r")\Z")
+    if excluded_extensions:
+        # パスの末尾が除外拡張子
+        alternatives.append(r"(?:" + "|".join(map(re.escape, excluded_extensions)) + r")\Z")
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+def _parse_zip_file_path(zip_file: Union[str, IO[bytes]], additional_excluded_extensions: List[str] = None) -> dict:
+    """
+    ZIPファイル（パスまたはファイルオブジェクト）を解析し、指定されたルールでフィルタリングする。
     ユーザーが指定した追加の除外拡張子も考慮する。
+    各エントリはストリームとして1つずつ読み込むため、アーカイブ全体をメモリに展開しない。
     """
     print("--- Parsing ZIP file content ---")
 
@@ -96,34 +204,43 @@ def _parse_zip_file(zip_content_bytes: bytes, additional_excluded_extensions: Li
         # '.vscode/', '.idea/', '.project/', '.settings/',
         # '.cache/', '.next/', '.nuxt/'
     )
+    # ループ内で毎回判定関数を呼ばないよう、除外ルールを1つの正規表現にまとめておく
+    exclusion_pattern = _build_exclusion_pattern(EXCLUDED_DIRS, EXCLUDED_FILES, all_excluded_extensions)
     # -----------------------
 
     try:
         file_contents = {}
-        with io.BytesIO(zip_content_bytes) as zip_buffer:
-            with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
-                file_list = zip_ref.namelist()
-                for file_path in file_list:
-                    # ディレクトリ自体はスキップ
-                    if file_path.endswith('/'):
-                        continue
-
-                    # --- 除外フィルタリング処理 ---
-                    lower_file_path = file_path.lower()
-                    if (lower_file_path.startswith(EXCLUDED_DIRS) or
-                        os.path.basename(lower_file_path) in EXCLUDED_FILES or
-                        lower_file_path.endswith(all_excluded_extensions)):
-                        print(f"Skipping (excluded): {file_path}")
-                        continue
-                    # ---------------------------
-
-                    try:
-                        # 解析対象のファイルのみ読み込む
-                        file_contents[file_path] = zip_ref.read(file_path).decode('utf-8')
-                    except UnicodeDecodeError:
-                        # UTF-8でデコードできないファイルもスキップ
-                        print(f"Skipping (non-utf8): {file_path}")
-                        continue
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                # ディレクトリ自体はスキップ
+                if info.is_dir():
+                    continue
+
+                file_path = info.filename
+
+                # --- 除外フィルタリング処理 ---
+                if exclusion_pattern is not None and exclusion_pattern.search(file_path):
+                    print(f"Skipping (excluded): {file_path}")
+                    continue
+                # ---------------------------
+
+                # 展開後のサイズが上限を超えるファイルはスキップ
+                if info.file_size > ZIP_MAX_ENTRY_BYTES:
+                    print(f"Skipping (too large: {info.file_size} bytes): {file_path}")
+                    continue
+
+                try:
+                    # 解析対象のファイルのみ、ストリームとして読み込みながらデコードする
+                    with zip_ref.open(info, 'r') as raw:
+                        # 先頭部分を覗いてバイナリと判定できれば、全体をデコードせずにスキップする
+                        if _looks_binary(raw.peek(BINARY_SNIFF_BYTES)[:BINARY_SNIFF_BYTES]):
+                            print(f"Skipping (binary): {file_path}")
+                            continue
+                        file_contents[file_path] = io.TextIOWrapper(raw, encoding='utf-8', errors='strict', newline='').read()
+                except UnicodeDecodeError:
+                    # UTF-8でデコードできないファイルもスキップ
+                    print(f"Skipping (non-utf8): {file_path}")
+                    continue
         
         if not file_contents:
             return {"error": "No analyzable source code files found in the zip archive after filtering."}
@@ -136,61 +253,95 @@ def _parse_zip_file(zip_content_bytes: bytes, additional_excluded_extensions: Li
         return {"error": f"ZIP File Analyzer Error: {e}"}
 
 # --- MCP/ファイル処理ヘルパー関数 ---
-def _load_files_to_state(files_metadata: List[Dict[str, str]]) -> Dict[str, Any]:
+_ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed")
+
+def _load_file_to_state(bucket: storage.Bucket, file_meta: Dict[str, str]) -> Dict[str, Any]:
     """
-    Firestoreに記録されたファイルメタデータを元に、GCSからファイルを読み込み、
-    パースしてStateに追加する辞書を返す。
+    1ファイル分のメタデータを元にGCSからファイルを読み込み、パースして
+    Stateに追加する辞書（{outputKey: 値} またはエラー）を返す。
     """
-    if not FILE_BUCKET_NAME:
-        print("Warning: FILE_BUCKET_NAME is not set. Skipping file loading.")
+    gcs_path = file_meta.get("gcsPath")
+    output_key = file_meta.get("outputKey")
+    
+    if not gcs_path or not output_key:
+        print(f"Warning: Skipping file due to missing gcsPath or outputKey: {file_meta}")
         return {}
-        
-    loaded_data = {}
-    bucket = storage_client.bucket(FILE_BUCKET_NAME)
 
-    for file_meta in files_metadata:
-        gcs_path = file_meta.get("gcsPath")
-        output_key = file_meta.get("outputKey")
-        
-        if not gcs_path or not output_key:
-            print(f"Warning: Skipping file due to missing gcsPath or outputKey: {file_meta}")
-            continue
+    try:
+        print(f"--- Loading file '{gcs_path}' into state key '{output_key}' ---")
+        blob = bucket.blob(gcs_path)
+        # アップロード時に記録したcontent_typeを使い、存在確認のRPCを省略する
+        content_type = file_meta.get("contentType")
 
         try:
-            print(f"--- Loading file '{gcs_path}' into state key '{output_key}' ---")
-            blob = bucket.blob(gcs_path)
-            if not blob.exists():
-                raise FileNotFoundError(f"File not found in GCS: {gcs_path}")
-
-            file_content_bytes = blob.download_as_bytes()
-            content_type = blob.content_type
-
-            if content_type == "text/plain" or content_type == "application/json":
-                loaded_data[output_key] = file_content_bytes.decode('utf-8')
-            elif content_type == "text/csv":
-                df = pd.read_csv(io.BytesIO(file_content_bytes))
-                loaded_data[output_key] = df.to_dict(orient='records')
-            elif content_type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-                df = pd.read_excel(io.BytesIO(file_content_bytes))
-                loaded_data[output_key] = df.to_dict(orient='records')
             # 修正: Zipファイルの処理を追加
-            elif content_type in ("application/zip", "application/x-zip-compressed"):
+            if content_type in _ZIP_CONTENT_TYPES:
                 print(f"Processing ZIP file '{gcs_path}'...")
                 additional_exclusions = file_meta.get("excludedExtensions", [])
-                parsed_data = _parse_zip_file(file_content_bytes, additional_exclusions)
+
+                # ZIPはメモリ上に展開せず一時ファイルへストリーミングし、ZipFileにシークさせる
+                tmp_fd, tmp_path = tempfile.mkstemp(suffix=".zip")
+                os.close(tmp_fd)
+                try:
+                    blob.download_to_filename(tmp_path)
+                    parsed_data = _parse_zip_file_path(tmp_path, additional_exclusions)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
                 
                 # 解析結果をoutputKeyにセット。エラーもそのまま格納する
-                loaded_data[output_key] = parsed_data
-            else:
-                # サポート外の形式はとりあえずテキストとして読み込む
-                print(f"Warning: Unsupported content type '{content_type}' for '{gcs_path}'. Loading as text.")
-                loaded_data[output_key] = file_content_bytes.decode('utf-8', errors='ignore')
+                return {output_key: parsed_data}
 
-        except Exception as e:
-            traceback.print_exc()
-            # ファイル読み込みエラーはワークフロー全体を停止させず、エラーメッセージをStateに入れる
-            error_key = f"{output_key}_error"
-            loaded_data[error_key] = f"Failed to load file '{gcs_path}': {str(e)}"
+            file_content_bytes = blob.download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(f"File not found in GCS: {gcs_path}")
+
+        content_type = content_type or blob.content_type
+
+        if content_type in _ZIP_CONTENT_TYPES:
+            # メタデータにcontentTypeがなく、ダウンロード後にZIPと判明した場合はメモリ上で解析する
+            print(f"Processing ZIP file '{gcs_path}'...")
+            return {output_key: _parse_zip_file_path(io.BytesIO(file_content_bytes), file_meta.get("excludedExtensions", []))}
+        elif content_type == "text/plain" or content_type == "application/json":
+            return {output_key: file_content_bytes.decode('utf-8')}
+        elif content_type == "text/csv":
+            # pyarrowのCSVリーダーで列指向に読み込み、そこから行ごとの辞書に変換する
+            table = pv.read_csv(pa.BufferReader(file_content_bytes))
+            return {output_key: table.to_pylist()}
+        elif content_type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
+            # Rust実装のcalamineエンジンで読み込む
+            df = pd.read_excel(io.BytesIO(file_content_bytes), engine='calamine')
+            return {output_key: df.to_dict(orient='records')}
+        else:
+            # サポート外の形式はとりあえずテキストとして読み込む
+            print(f"Warning: Unsupported content type '{content_type}' for '{gcs_path}'. Loading as text.")
+            return {output_key: file_content_bytes.decode('utf-8', errors='ignore')}
+
+    except Exception as e:
+        traceback.print_exc()
+        # ファイル読み込みエラーはワークフロー全体を停止させず、エラーメッセージをStateに入れる
+        error_key = f"{output_key}_error"
+        return {error_key: f"Failed to load file '{gcs_path}': {str(e)}"}
+
+def _load_files_to_state(files_metadata: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Firestoreに記録されたファイルメタデータを元に、GCSからファイルを読み込み、
+    パースしてStateに追加する辞書を返す。
+    GCSへのアクセスはI/O待ちが支配的なため、ファイルごとにスレッドで並列に読み込む。
+    """
+    if not FILE_BUCKET_NAME:
+        print("Warning: FILE_BUCKET_NAME is not set. Skipping file loading.")
+        return {}
+    if not files_metadata:
+        return {}
+        
+    loaded_data = {}
+    bucket = get_bucket()
+
+    with ThreadPoolExecutor(max_workers=min(FILE_LOAD_MAX_WORKERS, len(files_metadata))) as executor:
+        # 完了順ではなく投入順に結果をマージし、outputKeyが重複した場合は従来どおり後のファイルを優先する
+        for file_data in executor.map(lambda file_meta: _load_file_to_state(bucket, file_meta), files_metadata):
+            loaded_data.update(file_data)
 
     return loaded_data
 
@@ -200,9 +351,12 @@ def get_raw_content(content_dict: Dict, content_type: str, content_name: str) ->
         raise FileNotFoundError(f"{content_type.capitalize()} '{content_name}' not found in workflow data.")
     return content_dict[content_type][content_name]
 
-def _get_value_from_state(state: dict, key_path: str):
+def _split_key_path(key_path: str) -> List[str]:
+    """'a.b[0]["c"]' のような変数パスを、Stateを辿るためのキーのリストに分解する"""
     key_path = re.sub(r"\[['\"]?(.+?)['\"]?\]", r".\1", key_path)
-    keys = key_path.split('.')
+    return key_path.split('.')
+
+def _get_value_from_state(state: dict, keys: List[str]):
     value = state
     for key in keys:
         if isinstance(value, dict) and key in value:
@@ -210,6 +364,66 @@ def _get_value_from_state(state: dict, key_path: str):
         else:
             return None
     return value
+
+def _scan_prompt_variables(raw_template: str):
+    """
+    テンプレートを先頭から一度だけ走査し、{変数パス} の (開始位置, 終了位置, 変数パス) を順に返す。
+    従来の正規表現 {(.+?)} と同じく、変数パスは1文字以上で改行を含まないものに限る。
+    """
+    pos = 0
+    while True:
+        start = raw_template.find('{', pos)
+        if start == -1:
+            return
+        # 変数パスは1文字以上必要なため、閉じ括弧は start + 2 以降から探す
+        end = raw_template.find('}', start + 2)
+        if end == -1:
+            return
+        if raw_template.find('\n', start + 1, end) != -1:
+            # 改行を挟む場合はこの '{' を変数の開始とみなさず、次の位置から探し直す
+            pos = start + 1
+            continue
+        yield start, end + 1, raw_template[start + 1:end]
+        pos = end + 1
+
+def _compile_prompt(raw_template: str) -> Tuple[List[Union[str, int]], List[Tuple[str, List[str]]]]:
+    """
+    プロンプトテンプレートを、リテラル文字列と変数（pathsへのインデックス）が並んだセグメント列に分解する。
+    変数パスの分解もここで済ませておき、ノード実行時には正規表現を使わずにStateを辿るだけにする。
+    """
+    segments: List[Union[str, int]] = []
+    paths: List[Tuple[str, List[str]]] = []
+    pos = 0
+    for start, end, var_path in _scan_prompt_variables(raw_template):
+        if start > pos:
+            segments.append(raw_template[pos:start])
+        segments.append(len(paths))
+        paths.append((var_path, _split_key_path(var_path)))
+        pos = end
+    if pos < len(raw_template):
+        segments.append(raw_template[pos:])
+    return segments, paths
+
+def _render_prompt(segments: List[Union[str, int]], paths: List[Tuple[str, List[str]]], state: dict) -> str:
+    """_compile_promptで分解したテンプレートに、Stateの値を埋め込む"""
+    parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+            continue
+
+        var_path, keys = paths[segment]
+        value = _get_value_from_state(state, keys)
+        if value is None:
+            raise KeyError(f"Variable '{var_path}' not found in state.")
+
+        if isinstance(value, (dict, list)):
+            # CSV由来の日付などJSON非対応の型は文字列として埋め込む
+            value_str = json.dumps(value, ensure_ascii=False, default=str)
+        else:
+            value_str = str(value)
+        parts.append(value_str)
+    return ''.join(parts)
     
 # --- LangGraph構築 ---
 def create_dynamic_agent_state(config: Dict[str, Any]) -> Type[TypedDict]:
@@ -237,45 +451,21 @@ def create_dynamic_agent_state(config: Dict[str, Any]) -> Type[TypedDict]:
     return TypedDict('AgentState', state_keys, total=False)
 
 
-def create_llm_node(prompt_name: str, workflow_data: Dict):
+def create_llm_node(prompt_name: str, workflow_data: Dict, node_index: Dict[str, Dict]):
+    # テンプレートはワークフロー実行中に変わらないため、グラフ構築時に一度だけ解析する
+    raw_prompt_template = get_raw_content(workflow_data, "prompts", prompt_name)
+    segments, paths = _compile_prompt(raw_prompt_template)
+
     def node_function(state: Dict[str, Any]) -> dict:
         print(f"--- Running LLM Node: {prompt_name} ---")
         if state.get("error"): return {}
         try:
-            raw_prompt_template = get_raw_content(workflow_data, "prompts", prompt_name)
-
-            def format_variable(match):
-                var_path = match.group(1)
-                
-                if var_path == 'input':
-                    return f"{{{var_path}}}"
-
-                value = _get_value_from_state(state, var_path)
-                
-                if value is not None:
-                    if isinstance(value, (dict, list)):
-                        value_str = json.dumps(value, ensure_ascii=False)
-                    else:
-                        value_str = str(value)
-                    
-                    escaped_value = value_str.replace("{", "{{").replace("}", "}}")
-                    return escaped_value
-                
-                raise KeyError(f"Variable '{var_path}' not found in state.")
-
-            formatted_prompt_str = re.sub(r"\{(.+?)\}", format_variable, raw_prompt_template)
-            
-            prompt = PromptTemplate.from_template(formatted_prompt_str)
+            formatted_prompt_str = _render_prompt(segments, paths, state)
             
-            chain = prompt | llm | StrOutputParser()
+            # 埋め込み済みの文字列をそのままLLMに渡す（PromptTemplateによる再解析は不要）
+            result = get_llm().invoke(formatted_prompt_str)
 
-            invoke_input = {}
-            if 'input' in prompt.input_variables and 'input' in state:
-                invoke_input['input'] = state['input']
-            
-            result = chain.invoke(invoke_input)
-
-            node_config = next((n for n in workflow_data['config'].get('nodes', []) if n['id'] == prompt_name), None)
+            node_config = node_index.get(prompt_name)
             if not node_config: raise ValueError(f"Node config for '{prompt_name}' not found.")
             output_key = node_config.get('output_key')
             if not output_key: return {}
@@ -290,7 +480,47 @@ def create_llm_node(prompt_name: str, workflow_data: Dict):
             return {"error": f"Error in llm node '{prompt_name}': {str(e)}"}
     return node_function
 
-def create_python_node(script_name: str, workflow_data: Dict):
+# RestrictedPython用の安全な実行環境を定義（呼び出しごとに変わらないため、インポート時に一度だけ構築する）
+_RESTRICTED_GLOBALS = {
+    "__builtins__": safe_builtins,
+    "_getiter_": iter,
+    "_getitem_": lambda obj, key: obj[key],
+    "_write_": full_write_guard,
+    "getattr": safer_getattr,
+    
+    # シーケンスアンパッキング（例: a, b = [1, 2]）を許可するためのヘルパー関数
+    'iter_unpack_sequence': guarded_iter_unpack_sequence,
+
+    # forループなど、別の種類のアンパッキングに対応するためのヘルパー関数
+    '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
+
+    # ユーザーのスクリプト内で使用を許可する安全な組み込み型
+    "list": list,
+    "dict": dict,
+    "set": set,
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "tuple": tuple,
+
+    # ユーザーに公開したい安全なツール
+    "json": json,
+    # "llm" はクライアントを遅延生成するため、実行時に追加する
+    "PromptTemplate": PromptTemplate,
+    "StrOutputParser": StrOutputParser,
+}
+
+@functools.lru_cache(maxsize=256)
+def _compile_script(script_name: str, script_code: str) -> CodeType:
+    """信頼できないコードを制限された環境でコンパイルする。同じスクリプトの再コンパイルはキャッシュで省略する"""
+    return compile_restricted(
+        script_code,
+        filename=f"<safe_script_{script_name}>",
+        mode='exec'
+    )
+
+def create_python_node(script_name: str, workflow_data: Dict, node_index: Dict[str, Dict]):
     """PythonコードをRestrictedPythonを用いて安全に実行するノードを作成する高階関数"""
     def node_function(state: Dict[str, Any]) -> dict:
         print(f"--- Running Python Node: {script_name} ---")
@@ -298,55 +528,21 @@ def create_python_node(script_name: str, workflow_data: Dict):
         try:
             script_code = get_raw_content(workflow_data, "scripts", script_name)
             
-            # RestrictedPython用の安全な実行環境を定義
-            restricted_globals = {
-                "__builtins__": safe_builtins,
-                "_getiter_": iter,
-                "_getitem_": lambda obj, key: obj[key],
-                "_write_": full_write_guard,
-                "getattr": safer_getattr,
-                
-                # シーケンスアンパッキング（例: a, b = [1, 2]）を許可するためのヘルパー関数
-                'iter_unpack_sequence': guarded_iter_unpack_sequence,
-
-                # forループなど、別の種類のアンパッキングに対応するためのヘルパー関数
-                '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
-
-                # ユーザーのスクリプト内で使用を許可する安全な組み込み型
-                "list": list,
-                "dict": dict,
-                "set": set,
-                "str": str,
-                "int": int,
-                "float": float,
-                "bool": bool,
-                "tuple": tuple,
-
-                # ユーザーに公開したい安全なツール
-                "json": json,
-                "llm": llm,
-                "PromptTemplate": PromptTemplate,
-                "StrOutputParser": StrOutputParser,
-            }
-            
-            # 信頼できないコードを、制限された環境でコンパイル
-            byte_code = compile_restricted(
-                script_code,
-                filename=f"<safe_script_{script_name}>",
-                mode='exec'
-            )
+            # 信頼できないコードを、制限された環境でコンパイル（キャッシュ済みならそれを再利用）
+            byte_code = _compile_script(script_name, script_code)
             
             local_scope = {}
             
             # コンパイルされた安全なバイトコードを実行
-            exec(byte_code, restricted_globals, local_scope)
+            # スクリプトがグローバル変数を書き換えても他の実行に影響しないよう、浅いコピーを渡す
+            exec(byte_code, {**_RESTRICTED_GLOBALS, "llm": get_llm()}, local_scope)
 
             if 'main' not in local_scope or not callable(local_scope['main']):
                 raise TypeError(f"Script '{script_name}.py' must define a 'main(state)' function.")
             
             result = local_scope['main'](state)
             
-            node_config = next((n for n in workflow_data['config'].get('nodes', []) if n['id'] == script_name), None)
+            node_config = node_index.get(script_name)
             if not node_config: raise ValueError(f"Node config for '{script_name}' not found.")
             output_key = node_config.get('output_key')
             if not output_key: return {}
@@ -370,14 +566,16 @@ def join_node(state: Dict[str, Any]) -> dict:
 def build_graph_from_config(workflow_data: dict, agent_state_class: Type[TypedDict]):
     config = workflow_data['config']
     workflow = StateGraph(agent_state_class)
+    # ノード実行のたびに設定を線形探索しないよう、ID→設定の索引を一度だけ作成する
+    node_index = {n['id']: n for n in config.get('nodes', [])}
     for node_config in config.get('nodes', []):
         node_id, node_type = node_config['id'], node_config['type']
         if node_type == 'llm':
-            workflow.add_node(node_id, create_llm_node(node_id, workflow_data))
+            workflow.add_node(node_id, create_llm_node(node_id, workflow_data, node_index))
         elif node_type == 'join':
             workflow.add_node(node_id, join_node)
         elif node_type == 'python':
-            workflow.add_node(node_id, create_python_node(node_id, workflow_data))
+            workflow.add_node(node_id, create_python_node(node_id, workflow_data, node_index))
     workflow.set_entry_point(config["entry_point"])
     for edge_config in config["edges"]:
         source, target = edge_config["source"], edge_config["target"]
@@ -390,6 +588,308 @@ def build_graph_from_config(workflow_data: dict, agent_state_class: Type[TypedDi
     return workflow.compile()
 
 
+# --- 静的ファイル配信ヘルパー関数 ---
+# コンテナの稼働中に静的ファイルは変わらないため、読み込んだ内容をメモリに保持する
+# filepath -> (content, etag, content_type)
+_STATIC_DIR = os.path.realpath('static')
+_STATIC_CACHE: Dict[str, Tuple[bytes, str, str]] = {}
+
+def _load_static_file(filepath: str) -> Optional[Tuple[bytes, str, str]]:
+    """静的ファイルの内容・ETag・Content-Typeを返す。初回のみディスクから読み込み、以降はキャッシュを返す"""
+    # 'static//index.html' や 'static/./index.html' などの表記ゆれを実パスに正規化してキーにし、
+    # static/ 配下の実在ファイルだけを扱うことで、キャッシュの件数をファイル数で頭打ちにする
+    filepath = os.path.realpath(filepath)
+    cached = _STATIC_CACHE.get(filepath)
+    if cached is not None:
+        return cached
+    if os.path.commonpath([filepath, _STATIC_DIR]) != _STATIC_DIR or not os.path.isfile(filepath):
+        return None
+
+    content_type = 'text/html; charset=utf-8'
+    if filepath.endswith('.js'): content_type = 'application/javascript; charset=utf-8'
+    if filepath.endswith('.css'): content_type = 'text/css; charset=utf-8'
+    # ファイルはUTF-8で保存されているため、デコード・再エンコードせずバイト列のまま返す
+    with open(filepath, 'rb') as f: content = f.read()
+    etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+
+    cached = (content, etag, content_type)
+    _STATIC_CACHE[filepath] = cached
+    return cached
+
+
+# --- JSONレスポンスヘルパー関数 ---
+def _default_serializer(obj):
+    try: return str(obj)
+    except TypeError: return f"<non-serializable: {type(obj).__qualname__}>"
+
+def _to_json(obj, pretty: bool = False) -> bytes:
+    """APIレスポンス用にorjsonでシリアライズする（UTF-8のバイト列を返す）"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    try:
+        return orjson.dumps(obj, option=option, default=_default_serializer)
+    except orjson.JSONEncodeError:
+        # orjsonは64bitを超える整数を扱えず、defaultも呼ばないため標準のjsonで再シリアライズする
+        return json.dumps(obj, ensure_ascii=False, default=_default_serializer,
+                          indent=2 if pretty else None).encode('utf-8')
+
+
+# --- APIハンドラ ---
+# 各ハンドラは (request, uid, path_parts) を受け取り、(レスポンス本文, ステータスコード) を返す
+_WORKFLOW_NOT_FOUND = {"error": "Workflow not found or access denied"}
+
+def _workflows_collection():
+    return get_db().collection('workflows')
+
+def _is_valid_document_id(document_id: str) -> bool:
+    """FirestoreのドキュメントIDとして使える文字列か（'/'を含まない、'.'/'..'や__.*__でない、1500バイト以下）"""
+    return ('/' not in document_id
+            and document_id not in ('.', '..')
+            and not (document_id.startswith('__') and document_id.endswith('__'))
+            and len(document_id.encode('utf-8')) <= 1500)
+
+# --- ワークフロー一覧 (GET /api/workflows) ---
+def _list_workflows(request, uid: str, path_parts: List[str]):
+    workflows_collection = _workflows_collection()
+
+    # ページング: ?limit=50&startAfter=<前ページ最後のワークフローID>
+    try:
+        limit = int(request.args.get('limit', WORKFLOW_LIST_DEFAULT_LIMIT))
+    except ValueError:
+        return (_to_json({"error": "'limit' must be an integer"}), 400)
+    limit = max(1, min(limit, WORKFLOW_LIST_MAX_LIMIT))
+    start_after = request.args.get('startAfter')
+    # Firestoreのドキュメントとして参照できないIDは500にせず、入力エラーとして返す
+    if start_after and not _is_valid_document_id(start_after):
+        return (_to_json({"error": "'startAfter' must be a valid workflow ID"}), 400)
+
+    # 一覧表示に必要なnameフィールドだけを取得し、config等の大きなフィールドの転送を避ける
+    # ドキュメントID順に並べることで、複合インデックスなしでカーソルによるページングができる
+    query = (workflows_collection
+             .where(filter=FieldFilter('userId', '==', uid))
+             .select(['name'])
+             .order_by(firestore.FieldPath.document_id())
+             .limit(limit))
+    if start_after:
+        query = query.start_after({firestore.FieldPath.document_id(): workflows_collection.document(start_after)})
+
+    workflows = [{"id": doc.id, "name": doc.to_dict().get('name', 'Untitled')} for doc in query.stream()]
+    next_cursor = workflows[-1]["id"] if len(workflows) == limit else None
+    return (_to_json({"items": workflows, "nextCursor": next_cursor}), 200)
+
+# --- ワークフロー作成 (POST /api/workflows) ---
+def _create_workflow(request, uid: str, path_parts: List[str]):
+    data = request.get_json()
+    new_workflow = {
+        'userId': uid,
+        'name': data.get('name', 'New Workflow'),
+        'config': data.get('config'),
+        'prompts': data.get('prompts'),
+        'scripts': data.get('scripts'),
+        'files': data.get('files', []),
+        'createdAt': datetime.now(),
+        'updatedAt': datetime.now(),
+    }
+    update_time, doc_ref = _workflows_collection().add(new_workflow)
+    return (_to_json({"id": doc_ref.id, "message": "Workflow created"}), 201)
+
+# --- ワークフロー取得 (GET /api/workflows/{id}) ---
+def _get_workflow(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    workflow_data = _get_owned_workflow(_workflows_collection().document(workflow_id), uid)
+    if workflow_data is None:
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+    workflow_data['createdAt'] = str(workflow_data.get('createdAt'))
+    workflow_data['updatedAt'] = str(workflow_data.get('updatedAt'))
+    return (_to_json(workflow_data), 200)
+
+# --- ワークフロー更新 (PUT /api/workflows/{id}) ---
+def _update_workflow(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    doc_ref = _workflows_collection().document(workflow_id)
+    data = request.get_json()
+    data['updatedAt'] = datetime.now()
+
+    # 所有者確認と更新を1つのトランザクションで行う
+    @firestore.transactional
+    def update_owned_workflow(transaction):
+        if _get_owned_workflow(doc_ref, uid, transaction) is None:
+            return False
+        transaction.update(doc_ref, data)
+        return True
+
+    if not update_owned_workflow(get_db().transaction()):
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+    return (_to_json({"message": "Workflow updated"}), 200)
+
+def _delete_gcs_objects(gcs_paths: List[str]) -> None:
+    """
+    GCSオブジェクトをGCS_BATCH_MAX_SIZE件ずつのバッチHTTPリクエストでまとめて削除する。
+    既に存在しないオブジェクトは削除済みとして扱い、それ以外の失敗は例外として送出する。
+    """
+    bucket = get_bucket()
+    for start in range(0, len(gcs_paths), GCS_BATCH_MAX_SIZE):
+        batch_paths = gcs_paths[start:start + GCS_BATCH_MAX_SIZE]
+        try:
+            with get_storage().batch():
+                for gcs_path in batch_paths:
+                    print(f"Deleting GCS object: {gcs_path}")
+                    bucket.blob(gcs_path).delete()
+        except GoogleCloudError:
+            # バッチ内のどれかが失敗した場合は1件ずつ削除し直し、404だけを無視する
+            # （削除は冪等なため、バッチで削除済みのオブジェクトは404になるだけ）
+            for gcs_path in batch_paths:
+                try:
+                    bucket.blob(gcs_path).delete()
+                except NotFound:
+                    pass
+
+# --- ワークフロー削除 (DELETE /api/workflows/{id}) ---
+def _delete_workflow(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    doc_ref = _workflows_collection().document(workflow_id)
+    doc_data = _get_owned_workflow(doc_ref, uid)
+    if doc_data is None:
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+    
+    # GCSのファイルを先に削除する。失敗した場合はドキュメントを残し、ファイルが孤立しないようにする
+    if FILE_BUCKET_NAME and doc_data.get('files'):
+        _delete_gcs_objects([file_meta['gcsPath'] for file_meta in doc_data['files'] if 'gcsPath' in file_meta])
+    
+    doc_ref.delete()
+    return (_to_json({"message": "Workflow deleted"}), 200)
+
+# --- ファイルアップロード (POST /api/workflows/{id}/upload) ---
+def _upload_file(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    doc_ref = _workflows_collection().document(workflow_id)
+    if _get_owned_workflow(doc_ref, uid) is None:
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+    
+    if 'file' not in request.files:
+        return (_to_json({"error": "No file part in the request"}), 400)
+    
+    file = request.files['file']
+    output_key = request.form.get('outputKey')
+    excluded_extensions_str = request.form.get('excludedExtensions', '')
+
+    if not file.filename:
+        return (_to_json({"error": "No selected file"}), 400)
+    if not output_key:
+        return (_to_json({"error": "'outputKey' is required"}), 400)
+
+    bucket = get_bucket()
+    gcs_path = f"users/{uid}/{workflow_id}/{file.filename}"
+    blob = bucket.blob(gcs_path)
+    
+    blob.upload_from_file(file, content_type=file.content_type)
+    
+    # 除外拡張子をリストに変換
+    excluded_extensions_list = []
+    if excluded_extensions_str:
+        # カンマで分割し、前後の空白を除去、'.'がなければ付与する
+        excluded_extensions_list = [
+            f".{ext.strip().lstrip('.')}" for ext in excluded_extensions_str.split(',') if ext.strip()
+        ]
+
+    new_file_meta = {
+        "fileName": file.filename,
+        "outputKey": output_key,
+        "gcsPath": gcs_path,
+        "contentType": file.content_type,
+        "excludedExtensions": excluded_extensions_list
+    }
+    
+    doc_ref.update({
+        "files": firestore.ArrayUnion([new_file_meta])
+    })
+    
+    return (_to_json(new_file_meta), 200)
+
+# --- ファイル削除 (DELETE /api/workflows/{id}/files/{file_name}) ---
+def _delete_file(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    file_name_to_delete = path_parts[4]
+    doc_ref = _workflows_collection().document(workflow_id)
+    if _get_owned_workflow(doc_ref, uid) is None:
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+
+    # GCSのファイルを先に削除する。失敗した場合はファイル一覧に残し、削除を再試行できるようにする
+    gcs_path = f"users/{uid}/{workflow_id}/{file_name_to_delete}"
+    try:
+        get_bucket().blob(gcs_path).delete()
+    except NotFound:
+        # 既に存在しない場合は削除済みとして扱う
+        pass
+
+    # 所有者確認とファイル一覧の更新を1つのトランザクションで行う
+    @firestore.transactional
+    def remove_owned_file(transaction):
+        doc_data = _get_owned_workflow(doc_ref, uid, transaction)
+        if doc_data is None:
+            return False
+        files_to_keep = [f for f in doc_data.get('files', []) if f.get('fileName') != file_name_to_delete]
+        transaction.update(doc_ref, {"files": files_to_keep})
+        return True
+
+    if not remove_owned_file(get_db().transaction()):
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+    
+    return (_to_json({"message": f"File '{file_name_to_delete}' deleted"}), 200)
+
+# --- ワークフロー実行 (POST /api/workflows/{id}/execute) ---
+def _execute_workflow(request, uid: str, path_parts: List[str]):
+    workflow_id = path_parts[2]
+    workflow_data = _get_owned_workflow(_workflows_collection().document(workflow_id), uid)
+    if workflow_data is None:
+        return (_to_json(_WORKFLOW_NOT_FOUND), 404)
+
+    request_data = request.get_json(silent=True)
+    if not request_data or 'input' not in request_data:
+        return (_to_json({"error": "JSON payload with 'input' key is required."}), 400)
+
+    config = workflow_data.get('config', {})
+    config['files'] = workflow_data.get('files', []) # State生成のためにファイル情報もconfigに含める
+
+    DynamicAgentState = create_dynamic_agent_state(config)
+    app = build_graph_from_config(workflow_data, DynamicAgentState)
+    
+    initial_state = {"input": request_data.get('input', '')}
+    file_data = _load_files_to_state(workflow_data.get('files', []))
+    initial_state.update(file_data)
+    
+    final_state = app.invoke(initial_state)
+
+    if final_state.get("error"):
+        return (_to_json({"error": final_state["error"]}), 500)
+
+    final_output_key = config.get("final_output_key", "final_document")
+    final_doc = final_state.get(final_output_key, "No final document generated.")
+    response_data = {"final_document": final_doc, "full_state": final_state}
+    
+    # 整形出力はサイズが数倍になるため、?pretty=1 が指定された場合のみ行う
+    pretty = request.args.get('pretty') == '1'
+    return (_to_json(response_data, pretty=pretty), 200)
+
+# --- APIルーティングテーブル ---
+# (HTTPメソッド, パスのパターン) -> ハンドラ。パスのパターンではIDの位置を ':id' で表す
+_API_ROUTES = {
+    ('GET', ('api', 'workflows')): _list_workflows,
+    ('POST', ('api', 'workflows')): _create_workflow,
+    ('GET', ('api', 'workflows', ':id')): _get_workflow,
+    ('PUT', ('api', 'workflows', ':id')): _update_workflow,
+    ('DELETE', ('api', 'workflows', ':id')): _delete_workflow,
+    ('POST', ('api', 'workflows', ':id', 'upload')): _upload_file,
+    ('DELETE', ('api', 'workflows', ':id', 'files', ':id')): _delete_file,
+    ('POST', ('api', 'workflows', ':id', 'execute')): _execute_workflow,
+}
+
+def _route_key(method: str, path_parts: List[str]) -> Tuple[str, Tuple[str, ...]]:
+    """リクエストを_API_ROUTESのキーに変換する（3番目と5番目のパス要素がID）"""
+    return (method, tuple(':id' if i in (2, 4) else part for i, part in enumerate(path_parts)))
+
+
 # --- HTTPリクエストハンドラ ---
 @functions_framework.http
 def handle_request(request):
@@ -405,18 +905,23 @@ def handle_request(request):
     
     if path_parts[0] == '' or path_parts[0] == 'static':
         filepath = 'static/index.html' if path_parts[0] == '' else request.path.lstrip('/')
-        if os.path.exists(filepath):
+        static_file = _load_static_file(filepath)
+        if static_file is not None:
+            content, etag, content_type = static_file
             response_headers = base_headers.copy()
-            content_type = 'text/html; charset=utf-8'
-            if filepath.endswith('.js'): content_type = 'application/javascript; charset=utf-8'
-            if filepath.endswith('.css'): content_type = 'text/css; charset=utf-8'
             response_headers['Content-Type'] = content_type
-            with open(filepath, 'r', encoding='utf-8') as f: content = f.read()
+            response_headers['ETag'] = etag
+            # デプロイ後に古いindex.html/script.jsが使われないよう、毎回ETagで再検証させる
+            response_headers['Cache-Control'] = 'no-cache'
+            # クライアントが同じ内容を保持していれば本文を返さない
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+                return ('', 304, response_headers)
             return (content, 200, response_headers)
         else:
             response_headers = base_headers.copy()
             response_headers['Content-Type'] = 'application/json; charset=utf-8'
-            return (json.dumps({"error": "Not Found"}), 404, response_headers)
+            return (_to_json({"error": "Not Found"}), 404, response_headers)
 
     # APIルーティング
     if path_parts[0] == 'api':
@@ -425,186 +930,17 @@ def handle_request(request):
 
         try:
             uid = _get_uid_from_request(request)
-            workflows_collection = db.collection('workflows')
-
-            if len(path_parts) == 2 and path_parts[1] == 'workflows' and request.method == 'GET':
-                docs = workflows_collection.where(filter=FieldFilter('userId', '==', uid)).stream()
-                workflows = [{"id": doc.id, "name": doc.to_dict().get('name', 'Untitled')} for doc in docs]
-                return (json.dumps(workflows), 200, response_headers)
-
-            if len(path_parts) == 2 and path_parts[1] == 'workflows' and request.method == 'POST':
-                data = request.get_json()
-                new_workflow = {
-                    'userId': uid,
-                    'name': data.get('name', 'New Workflow'),
-                    'config': data.get('config'),
-                    'prompts': data.get('prompts'),
-                    'scripts': data.get('scripts'),
-                    'files': data.get('files', []),
-                    'createdAt': datetime.now(),
-                    'updatedAt': datetime.now(),
-                }
-                update_time, doc_ref = workflows_collection.add(new_workflow)
-                return (json.dumps({"id": doc_ref.id, "message": "Workflow created"}), 201, response_headers)
-
-            if len(path_parts) == 3 and path_parts[1] == 'workflows' and request.method == 'GET':
-                workflow_id = path_parts[2]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                if not doc.exists or doc.to_dict().get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-                workflow_data = doc.to_dict()
-                workflow_data['createdAt'] = str(workflow_data.get('createdAt'))
-                workflow_data['updatedAt'] = str(workflow_data.get('updatedAt'))
-                return (json.dumps(workflow_data), 200, response_headers)
-
-            if len(path_parts) == 3 and path_parts[1] == 'workflows' and request.method == 'PUT':
-                workflow_id = path_parts[2]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                if not doc.exists or doc.to_dict().get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-                data = request.get_json()
-                data['updatedAt'] = datetime.now()
-                doc_ref.update(data)
-                return (json.dumps({"message": "Workflow updated"}), 200, response_headers)
-
-            if len(path_parts) == 3 and path_parts[1] == 'workflows' and request.method == 'DELETE':
-                workflow_id = path_parts[2]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                doc_data = doc.to_dict()
-                if not doc.exists or doc_data.get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-                
-                if FILE_BUCKET_NAME and 'files' in doc_data:
-                    bucket = storage_client.bucket(FILE_BUCKET_NAME)
-                    for file_meta in doc_data['files']:
-                        if 'gcsPath' in file_meta:
-                            print(f"Deleting GCS object: {file_meta['gcsPath']}")
-                            blob = bucket.blob(file_meta['gcsPath'])
-                            if blob.exists():
-                                blob.delete()
-                
-                doc_ref.delete()
-                return (json.dumps({"message": "Workflow deleted"}), 200, response_headers)
-
-            # --- ファイルアップロード (POST /api/workflows/{id}/upload) ---
-            if len(path_parts) == 4 and path_parts[1] == 'workflows' and path_parts[3] == 'upload' and request.method == 'POST':
-                workflow_id = path_parts[2]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                if not doc.exists or doc.to_dict().get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-                
-                if 'file' not in request.files:
-                    return (json.dumps({"error": "No file part in the request"}), 400, response_headers)
-                
-                file = request.files['file']
-                output_key = request.form.get('outputKey')
-                excluded_extensions_str = request.form.get('excludedExtensions', '')
-
-                if not file.filename:
-                    return (json.dumps({"error": "No selected file"}), 400, response_headers)
-                if not output_key:
-                    return (json.dumps({"error": "'outputKey' is required"}), 400, response_headers)
-
-                bucket = storage_client.bucket(FILE_BUCKET_NAME)
-                gcs_path = f"users/{uid}/{workflow_id}/{file.filename}"
-                blob = bucket.blob(gcs_path)
-                
-                blob.upload_from_file(file, content_type=file.content_type)
-                
-                # 除外拡張子をリストに変換
-                excluded_extensions_list = []
-                if excluded_extensions_str:
-                    # カンマで分割し、前後の空白を除去、'.'がなければ付与する
-                    excluded_extensions_list = [
-                        f".{ext.strip().lstrip('.')}" for ext in excluded_extensions_str.split(',') if ext.strip()
-                    ]
-
-                new_file_meta = {
-                    "fileName": file.filename,
-                    "outputKey": output_key,
-                    "gcsPath": gcs_path,
-                    "contentType": file.content_type,
-                    "excludedExtensions": excluded_extensions_list
-                }
-                
-                doc_ref.update({
-                    "files": firestore.ArrayUnion([new_file_meta])
-                })
-                
-                return (json.dumps(new_file_meta), 200, response_headers)
-
-            # ... (DELETE /api/workflows/{id}/files/{file_name}) ...
-            if len(path_parts) == 5 and path_parts[1] == 'workflows' and path_parts[3] == 'files' and request.method == 'DELETE':
-                workflow_id = path_parts[2]
-                file_name_to_delete = path_parts[4]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                doc_data = doc.to_dict()
-
-                if not doc.exists or doc_data.get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-
-                gcs_path = f"users/{uid}/{workflow_id}/{file_name_to_delete}"
-                bucket = storage_client.bucket(FILE_BUCKET_NAME)
-                blob = bucket.blob(gcs_path)
-                if blob.exists():
-                    blob.delete()
-                
-                files_to_keep = [f for f in doc_data.get('files', []) if f.get('fileName') != file_name_to_delete]
-                doc_ref.update({"files": files_to_keep})
-                
-                return (json.dumps({"message": f"File '{file_name_to_delete}' deleted"}), 200, response_headers)
-
-
-            # ... (POST /api/workflows/{id}/execute) ...
-            if len(path_parts) == 4 and path_parts[1] == 'workflows' and path_parts[3] == 'execute' and request.method == 'POST':
-                workflow_id = path_parts[2]
-                doc_ref = workflows_collection.document(workflow_id)
-                doc = doc_ref.get()
-                if not doc.exists or doc.to_dict().get('userId') != uid:
-                    return (json.dumps({"error": "Workflow not found or access denied"}), 404, response_headers)
-
-                request_data = request.get_json(silent=True)
-                if not request_data or 'input' not in request_data:
-                    return (json.dumps({"error": "JSON payload with 'input' key is required."}), 400, response_headers)
-
-                workflow_data = doc.to_dict()
-                config = workflow_data.get('config', {})
-                config['files'] = workflow_data.get('files', []) # State生成のためにファイル情報もconfigに含める
-
-                DynamicAgentState = create_dynamic_agent_state(config)
-                app = build_graph_from_config(workflow_data, DynamicAgentState)
-                
-                initial_state = {"input": request_data.get('input', '')}
-                file_data = _load_files_to_state(workflow_data.get('files', []))
-                initial_state.update(file_data)
-                
-                final_state = app.invoke(initial_state)
-
-                if final_state.get("error"):
-                    return (json.dumps({"error": final_state["error"]}), 500, response_headers)
-
-                final_output_key = config.get("final_output_key", "final_document")
-                final_doc = final_state.get(final_output_key, "No final document generated.")
-                response_data = {"final_document": final_doc, "full_state": final_state}
-                
-                def default_serializer(obj):
-                    try: return str(obj)
-                    except TypeError: return f"<non-serializable: {type(obj).__qualname__}>"
-                
-                return (json.dumps(response_data, ensure_ascii=False, indent=2, default=default_serializer), 200, response_headers)
-
+            handler = _API_ROUTES.get(_route_key(request.method, path_parts))
+            if handler is not None:
+                body, status = handler(request, uid, path_parts)
+                return (body, status, response_headers)
         except PermissionError as e:
-            return (json.dumps({"error": str(e)}), 401, response_headers)
+            return (_to_json({"error": str(e)}), 401, response_headers)
         except Exception as e:
             traceback.print_exc()
-            return (json.dumps({"error": f"Internal Server Error: {str(e)}"}), 500, response_headers)
+            return (_to_json({"error": f"Internal Server Error: {str(e)}"}), 500, response_headers)
 
     # APIルートが見つからない場合
     response_headers = base_headers.copy()
     response_headers['Content-Type'] = 'application/json; charset=utf-8'
-    return (json.dumps({"error": "API Route Not Found"}), 404, response_headers)
\ No newline at end of file
+    return (_to_json({"error": "API Route Not Found"}), 404, response_headers)
\ No newline at end of file
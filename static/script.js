@@ -7,6 +7,7 @@ document.addEventListener('DOMContentLoaded', () => {
   // --- グローバル状態管理 ---
   let state = {
     workflows: [], // {id, name} のリスト
+    workflowsCursor: null, // ワークフロー一覧の次ページ取得用カーソル（最後のページならnull）
     currentWorkflow: null, // {id, name, config, prompts, scripts, files}
     selectedPrompt: null,
   };
@@ -155,12 +156,15 @@ document.addEventListener('DOMContentLoaded', () => {
   // --- ワークフロー管理ロジック ---
   async function loadWorkflows() {
     try {
-      state.workflows = await fetchAPI('/api/workflows');
+      const page = await fetchAPI('/api/workflows');
+      state.workflows = page.items;
+      state.workflowsCursor = page.nextCursor;
       renderWorkflowList();
       if (state.workflows.length > 0) {
         const currentId = state.currentWorkflow ? state.currentWorkflow.id : null;
         const currentExists = state.workflows.some(w => w.id === currentId);
-        const idToLoad = currentExists ? currentId : state.workflows[0].id;
+        // 選択中のワークフローが先頭ページに含まれなくても、続きのページがあれば選択を維持する
+        const idToLoad = (currentExists || (currentId && state.workflowsCursor)) ? currentId : state.workflows[0].id;
         await loadWorkflowDetail(idToLoad);
       } else {
         showEmptyState();
@@ -171,6 +175,22 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   }
 
+  async function loadMoreWorkflows() {
+    if (!state.workflowsCursor) return;
+    try {
+      const page = await fetchAPI(`/api/workflows?startAfter=${encodeURIComponent(state.workflowsCursor)}`);
+      state.workflows = state.workflows.concat(page.items);
+      state.workflowsCursor = page.nextCursor;
+      renderWorkflowList();
+      if (state.currentWorkflow) {
+        document.querySelector(`#workflow-list li[data-id="${state.currentWorkflow.id}"]`)?.classList.add('active');
+      }
+    } catch (error) {
+      console.error("Failed to load more workflows:", error);
+      alert("ワークフローの読み込みに失敗しました。");
+    }
+  }
+
   function showEmptyState() {
     state.currentWorkflow = null;
     workflowList.innerHTML = '<li>ワークフローがありません</li>';
@@ -263,6 +283,10 @@ document.addEventListener('DOMContentLoaded', () => {
   });
 
   workflowList.addEventListener('click', async (e) => {
+    if (e.target.closest('.load-more-workflows')) {
+      await loadMoreWorkflows();
+      return;
+    }
     const li = e.target.closest('li[data-id]');
     if (!li) return;
     const workflowId = li.dataset.id;
@@ -365,6 +389,12 @@ document.addEventListener('DOMContentLoaded', () => {
       `;
       workflowList.appendChild(li);
     });
+    if (state.workflowsCursor) {
+      const li = document.createElement('li');
+      li.className = 'load-more-workflows';
+      li.textContent = 'さらに読み込む';
+      workflowList.appendChild(li);
+    }
   }
 
   function renderFiles() {